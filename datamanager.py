@@ -1,13 +1,53 @@
+from contextlib import ExitStack
 from pathlib import Path
+import io
+import marshal
+import os
 import pickle
+import zlib
+
+# Protocol 4 writes large bytes payloads straight through to the file object,
+# so dumping into the management file never keeps a second copy of them in memory.
+# It is the newest protocol Python 3.7 can read, so the file stays readable there.
+_PROTOCOL = 4
+# Compaction writes many small records in a row, so it gathers them into larger writes.
+_BUFFER_SIZE = 1 << 20
+# The management file is compacted once superseded records make up more than this share of it.
+_COMPACTION_RATIO = 0.5
+# Records written by marshal, compressed or recording removals start with one of these tags and their length,
+# pickled records never do.
+_MARSHAL_TAG = b'M'
+_ZLIB_TAG = b'Z'
+_REMOVAL_TAG = b'R'
+_TAG_SIZE = 9
+# Level 1 compresses close to disk speed and already shrinks pickled data several times.
+_COMPRESS_LEVEL = 1
+_MARSHAL_TYPES = frozenset((type(None), bool, int, float, complex, str, bytes))
+_SERIALIZERS = ('pickle', 'marshal')
+
+
+# Marks a key removed from the management file in memory.
+# Removals are written as tagged records naming the keys, so the marker itself is never pickled.
+_TOMBSTONE = object()
 
 
 class DataManager:
+    def __contains__(self, key):
+        """This method is equivalent to exists(key).
+
+        Args:
+            key (str): The key you want to check.
+
+        Returns:
+            bool: True if the key exists.
+        """
+        return key in self.__data
+
     def __enter__(self):
         return self
 
     def __exit__(self, ex_type, message, traceback):
-        self.update()
+        self._compact_if_needed()
 
     def __getitem__(self, item):
         """This method is equivalent to load(key, strict = True).
@@ -23,7 +63,7 @@ class DataManager:
         """
         return self.load(item, True)
 
-    def __init__(self, file_name, *path, create_newly=True):
+    def __init__(self, file_name, *path, create_newly=True, serializer='pickle', compress=False):
         """To assist in the data management of the object by the pickle.
 
         Args:
@@ -34,6 +74,19 @@ class DataManager:
             create_newly (bool, optional):
                 Even if a management file with the same name already exists, set it to true if you want to overwrite it with a new file.
                 If the management file does not exist, this option does not matter.
+            serializer (str, optional): "pickle" or "marshal". Defaults to "pickle".
+                marshal only writes records whose keys and objects are all numbers, str, bytes or None,
+                which come out somewhat smaller and read faster than with pickle.
+                Records holding any other object, containers included, are written with pickle instead.
+                Files written with marshal can only be read by the same version of Python.
+            compress (bool, optional): Set it to true to compress each record with zlib. Defaults to False.
+                It suits objects that are large and rarely rewritten.
+                Records already in the management file keep the form they were written in until they are rewritten.
+
+        Raises:
+            ValueError: Thrown when the serializer is unknown.
+            Exception: Thrown when a record of the management file cannot be read.
+                Only a partly written last record is cut off instead, as long as a record before it can be read.
 
         Examples:
             The results of Case 1 and Case 2 is equal.
@@ -60,7 +113,23 @@ class DataManager:
                 [2, 3]
                 >>> dm.update()
         """
-        self._setup(file_name, path, create_newly)
+        self._setup(file_name, path, create_newly, serializer, compress)
+
+    def __iter__(self):
+        """Iterate over the keys in the order they were saved.
+
+        Returns:
+            iterator: The keys of the management file.
+        """
+        return iter(self.__data)
+
+    def __len__(self):
+        """Returns the number of keys in the management file.
+
+        Returns:
+            int: The number of keys.
+        """
+        return len(self.__data)
 
     def __setitem__(self, key, value):
         """This method is equivalent to rewrite(key, value).
@@ -68,22 +137,161 @@ class DataManager:
         Args:
             key (str): The key to be rewritten.
             value (object): The object corresponding to that key.
+
+        Raises:
+            Exception: Thrown when the object cannot be serialized. The saved object is left as it was.
         """
         self.rewrite(key, value)
 
-    def _get_generator(self):
-        """Acquires a generator that retrieves data stored in a management file one by one.
+    def _append(self, record):
+        """Appends a record to the end of the management file.
+
+        If the record cannot be pickled, the management file is restored to its previous length.
+
+        Args:
+            record (dict): Keys and the objects corresponding to them.
+        """
+        with open(self.__file, 'ab') as f:
+            inode = os.fstat(f.fileno()).st_ino
+            offset = f.tell()
+            if inode != self.__inode or offset != self.__size:
+                # Written by someone else since, so the recorded offsets are stale.
+                self._reset_index()
+                self.__inode = inode
+            try:
+                self._dump(record, f)
+            except Exception:
+                f.truncate(offset)
+                raise
+            size = f.tell() - offset
+        self._register(offset, size, record)
+
+    def _compact_if_needed(self):
+        """Call update if superseded records take up too much of the management file.
+        """
+        if self.__dead > self.__size * _COMPACTION_RATIO:
+            self.update()
+
+    def _dump(self, record, f, pickler=None):
+        """Writes a record with the serializer of the management file, compressing it if required.
+
+        A record of removals only holds the removed keys behind their own tag.
+
+        Args:
+            record (dict): Keys and the objects corresponding to them.
+            f (file): The management file opened for writing.
+            pickler (pickle.Pickler, optional): Pickler bound to f, reused when many records are written in a row.
+        """
+        if any(value is _TOMBSTONE for value in record.values()):
+            _write_tagged(f, _REMOVAL_TAG, pickle.dumps(list(record), protocol=_PROTOCOL))
+        elif self.__compress:
+            buffer = io.BytesIO()
+            self._serialize(record, buffer)
+            _write_tagged(f, _ZLIB_TAG, zlib.compress(buffer.getbuffer(), _COMPRESS_LEVEL))
+        else:
+            self._serialize(record, f, pickler)
+
+    def _is_replaced(self):
+        """Returns whether the management file was replaced or extended by someone else.
+
+        Returns:
+            bool: True if the recorded offsets can no longer be trusted.
+        """
+        try:
+            stat = os.stat(self.__file)
+        except FileNotFoundError:
+            return True
+        return stat.st_ino != self.__inode or stat.st_size != self.__size
+
+    def _read_records(self):
+        """Acquires a generator that retrieves the records of the management file one by one.
+
+        Yields:
+            tuple: The offset, size and contents of the record.
         """
-        if not self.__file.exists():
-            return
         with open(self.__file, 'rb') as f:
-            while True:
-                try:
-                    yield pickle.load(f)
-                except EOFError:
-                    break
+            # The unpickler peeks into the buffer of the file, while it reads a memory map one opcode at a time.
+            stat = os.fstat(f.fileno())
+            self.__inode = stat.st_ino
+            offset = 0
+            while offset < stat.st_size:
+                record = _load_record(f, stat.st_size - offset)
+                # Unlike tell, a relative seek inside the buffer answers without asking the system.
+                end = f.seek(0, io.SEEK_CUR)
+                yield offset, end - offset, record
+                offset = end
+
+    def _register(self, offset, size, keys):
+        """Points the keys at the record written at offset.
+
+        The records the keys pointed to until now are counted as superseded as soon as one of their keys is released.
+        Keys removed by the record are released without pointing at it.
+
+        Args:
+            offset (int): Position of the record in the management file.
+            size (int): Length of the record in bytes.
+            keys (dict or list): The keys held by the record.
+        """
+        self.__records[offset] = [size, 0, 0]
+        self.__size = offset + size
+        for key in keys:
+            self._release(key)
+            if isinstance(keys, dict) and keys[key] is _TOMBSTONE:
+                # A tombstone only has to outlive the records before it, so it is superseded from the start.
+                continue
+            self.__index[key] = offset
+            self.__records[offset][1] += 1
+            self.__records[offset][2] += 1
+        if not self.__records[offset][1]:
+            self.__dead += size
+            del self.__records[offset]
+
+    def _release(self, key):
+        """Stops the key from pointing at its record.
+
+        The whole record is counted as superseded on its first release, since update only copies records whose keys are all current.
+
+        Args:
+            key (str): The key to release.
+        """
+        offset = self.__index.pop(key, None)
+        if offset is None:
+            return
+        record = self.__records[offset]
+        if record[1] == record[2]:
+            self.__dead += record[0]
+        record[1] -= 1
+        if not record[1]:
+            del self.__records[offset]
+
+    def _reset_index(self):
+        """Forgets where the records of the management file are.
+        """
+        self.__index = {}
+        self.__records = {}
+        self.__dead = 0
+        self.__size = 0
+        self.__inode = None
+
+    def _serialize(self, record, f, pickler=None):
+        """Writes a record with the serializer of the management file, without compressing it.
+
+        Args:
+            record (dict): Keys and the objects corresponding to them.
+            f (file): The file to write to.
+            pickler (pickle.Pickler, optional): Pickler bound to f, reused when many records are written in a row.
+        """
+        if self.__serializer == 'marshal' and _is_flat(record):
+            _write_tagged(f, _MARSHAL_TAG, marshal.dumps(record))
+            return
+        if pickler is None:
+            pickle.dump(record, f, protocol=_PROTOCOL)
+        else:
+            pickler.dump(record)
+            # Every record must be readable on its own.
+            pickler.clear_memo()
 
-    def _setup(self, file_name, path, create_newly):
+    def _setup(self, file_name, path, create_newly, serializer, compress):
         """Perform various setup processes.
 
         This method is called automatically and should not be used.
@@ -94,7 +302,11 @@ class DataManager:
             path (tuple): File saving path.
                 Please refer to the __init__ method for more information.
             create_newly (bool): Even if a management file with the same name already exists, set it to true if you want to overwrite it with a new file.
+            serializer (str): The serializer of the records.
+                Please refer to the __init__ method for more information.
+            compress (bool): Whether to compress the records.
         """
+        self._setup_serializer(serializer, compress)
         self._setup_path(path)
         self._setup_file(file_name)
         self._setup_keys(create_newly)
@@ -116,27 +328,49 @@ class DataManager:
             file_name += ext
         self.__file_name = file_name
         self.__file = self.__path / self.__file_name
+        self.__tmp = self.__path / 'tmp.pkl'
 
     def _setup_keys(self, create_newly):
-        """Sets a list of keys that already exist.
+        """Reads the objects that already exist into memory.
+
+        The management file is only rewritten when it has to be created, emptied or compacted.
+        If its last record was only partly written, the records before it are kept and the partial record is cut off.
+        Any other record that cannot be read raises, and the management file is left as it is.
 
         This method is called automatically and should not be used.
 
         Args:
             create_newly (bool): Even if a management file with the same name already exists, set it to true if you want to overwrite it with a new file.
+
+        Raises:
+            Exception: Thrown when a record of the management file cannot be read,
+                other than a partly written last record after at least one readable record.
         """
-        if not create_newly:
+        self.__data = {}
+        self._reset_index()
+        if not create_newly and self.__file.exists():
+            end = 0
             try:
-                keys = []
-                for dict_ in self._get_generator():
-                    for key in dict_:
-                        keys.append(key)
-            except Exception:
-                keys = []
-        else:
-            keys = []
-        self.__keys = keys
-        self.update()
+                for offset, size, record in self._read_records():
+                    for key, value in record.items():
+                        if value is _TOMBSTONE:
+                            self.__data.pop(key, None)
+                        else:
+                            self.__data[key] = value
+                    self._register(offset, size, record)
+                    end = offset + size
+            except (EOFError, pickle.UnpicklingError) as e:
+                if not end or not _is_cut_off(e):
+                    raise
+                # A write cut off halfway leaves a partial record at the end, so only that record is discarded.
+                print(f"Discarded the partly written end of the management file({self.__file}) after {end} bytes.")
+                print(e)
+                with open(self.__file, 'r+b') as f:
+                    f.truncate(end)
+            self._compact_if_needed()
+            return
+        with open(self.__file, 'wb') as f:
+            self.__inode = os.fstat(f.fileno()).st_ino
 
     def _setup_path(self, path):
         """Set the save path of the management file.
@@ -160,11 +394,30 @@ class DataManager:
             raise e
         self.__path = path_
 
+    def _setup_serializer(self, serializer, compress):
+        """Set the serializer of the records and whether to compress them.
+
+        This method is called automatically and should not be used.
+
+        Args:
+            serializer (str): The serializer of the records.
+                Please refer to the __init__ method for more information.
+            compress (bool): Whether to compress the records.
+
+        Raises:
+            ValueError: Thrown when the serializer is unknown.
+        """
+        if serializer not in _SERIALIZERS:
+            raise ValueError(f"Unknown serializer({serializer}).")
+        self.__serializer = serializer
+        self.__compress = compress
+
     def add(self, **kwargs):
         """Save the objects in the management file.
 
         It is not possible to add a key that already exists.
         If you want to rewrite an existing key, use the rewrite method.
+        The objects are saved as they are at the time of the call, changing them in place afterwards is not saved.
 
         Examples:
             >>> from datamanager import DataManager
@@ -175,22 +428,32 @@ class DataManager:
             >>> print(dm.load('example'))
             textcontent
         """
+        record = {}
         for key in kwargs:
-            if key in self.__keys:
+            if key in self.__data:
                 err = (
                     f"Failed to add key({key}).", "Key that already exists.",
                     "Please use the \"rewrite\" method if you want to override.\n"
                 )
                 print("\n".join(err))
                 continue
-            try:
-                with open(self.__file, 'ab') as f:
-                    pickle.dump({key: kwargs[key]}, f)
-                self.__keys.append(key)
-            except Exception as e:
-                err = f"Failed to add key.({key})"
-                print(err)
-                print(e)
+            record[key] = kwargs[key]
+        if not record:
+            return
+        try:
+            self._append(record)
+        except Exception:
+            # Retry key by key so that only the objects that cannot be saved are rejected.
+            for key, value in record.items():
+                try:
+                    self._append({key: value})
+                    self.__data[key] = value
+                except Exception as e:
+                    err = f"Failed to add key.({key})"
+                    print(err)
+                    print(e)
+        else:
+            self.__data.update(record)
 
     def exists(self, key):
         """Returns whether the key is included in the management file.
@@ -201,7 +464,7 @@ class DataManager:
         Returns:
             bool: True if the key exists.
         """
-        return key in self.__keys
+        return key in self.__data
 
     def load(self, key, strict=True):
         """True if the key exists.
@@ -210,6 +473,9 @@ class DataManager:
         If strict is true, ValueError is thrown.
         Otherwise None is returned.
 
+        The returned object is the one the manager holds, not a copy.
+        Changing it in place is never saved to the management file, use rewrite to save a changed object.
+
         Args:
             key (str): The key of the object to read.
             strict (bool, optional): True if strict mode is enabled. Defaults to True.
@@ -220,11 +486,10 @@ class DataManager:
         Returns:
             object: The saved object.
         """
-        if key in self.__keys:
-            for dict_ in self._get_generator():
-                if key in dict_:
-                    return dict_[key]
-        err = f"Failed to read key({key})."
+        try:
+            return self.__data[key]
+        except KeyError:
+            err = f"Failed to read key({key})."
         if strict:
             raise ValueError(err)
         else:
@@ -253,20 +518,14 @@ class DataManager:
         err = None
         if not targets:
             err = "Please set the key one or more."
-        elif len(targets) != len(list(set(targets))):
+        elif len(set(targets)) != len(targets):
             err = "Key is a duplicate."
-        elif not all(map(lambda x: x in self.__keys, targets)):
+        elif not self.__data.keys() >= set(targets):
             if strict:
                 err = f"It contains a key that does not exist in the target({targets})."
         if err is not None:
             raise ValueError(err)
-        objects = {x: None for x in range(len(targets))}
-        for dict_ in self._get_generator():
-            for key in dict_:
-                if key in targets:
-                    index = targets.index(key)
-                    objects[index] = dict_[key]
-        return [x[1] for x in sorted(objects.items(), key=lambda x: x[0])]
+        return [self.__data.get(key) for key in targets]
 
     def remove(self, key):
         """Delete the object of the key from the management file.
@@ -277,10 +536,10 @@ class DataManager:
         Args:
             key (str): It is key that you want to delete.
         """
-        if key in self.__keys:
-            index = self.__keys.index(key)
-            del self.__keys[index]
-            self.update()
+        if key in self.__data:
+            self._append({key: _TOMBSTONE})
+            del self.__data[key]
+            self._compact_if_needed()
 
     def rewrite(self, key, value, *, should_add=True):
         """Already it overwrites the data of the key that exists.
@@ -292,6 +551,10 @@ class DataManager:
             value (object): The object corresponding to that key.
             should_add (bool, optional): Whether to add the target key if it does not exist. Defaults to True.
 
+        Raises:
+            Exception: Thrown when the object cannot be serialized, such as pickle.PicklingError.
+                Unlike add, which only reports it, the error is passed on. The saved object is left as it was.
+
         Examples:
             >>> from datamanager import DataManager
             >>> with DataManager('test.pkl') as dm:
@@ -307,10 +570,10 @@ class DataManager:
             ValueError: Failed to read key(example3).
 
         """
-        if key in self.__keys or should_add:
-            self.remove(key)
-            data = {key: value}
-            self.add(**data)
+        if should_add or key in self.__data:
+            self._append({key: value})
+            self.__data[key] = value
+            self._compact_if_needed()
 
     def show(self):
         """Output saved data correspondence table.
@@ -323,31 +586,153 @@ class DataManager:
             example1: ex1
             example2: ex2
         """
-        for obj in self._get_generator():
-            for d in obj.items():
-                key, value = d
-                print(f"{key}: {value}")
+        for key, value in self.__data.items():
+            print(f"{key}: {value}")
 
     def update(self):
         """To maintain the integrity of the management file, and update.
 
+        Records superseded by rewrite and the markers left by remove are dropped.
+        Records whose keys are all current are copied as they are, and the other objects are read back
+        from their records and written as records of their own.
+        So the management file always keeps the objects as they were when saved, even if they were changed in place since.
+        Only when another manager has replaced the management file are the objects written from memory.
         This method is called automatically and should not be used.
         """
-        tmp = self.__path / 'tmp.pkl'
-        with open(tmp, 'wb') as f:
-            for dict_ in self._get_generator():
-                for key in dict_:
-                    if key in self.__keys:
-                        f.write(pickle.dumps(dict_))
-        with open(tmp, 'rb') as i, open(self.__file, 'wb') as o:
-            o.write(i.read())
-        tmp.unlink()
+        if self.__index and self._is_replaced():
+            self._reset_index()
+        located = {}
+        for key, offset in self.__index.items():
+            if key in self.__data:
+                located.setdefault(offset, []).append(key)
+        intact = {offset: keys for offset, keys in located.items() if len(keys) == self.__records[offset][2]}
+        copied = set()
+        stored = {}
+        records = []
+        with open(self.__tmp, 'wb', buffering=_BUFFER_SIZE) as f, ExitStack() as stack:
+            if located:
+                old = stack.enter_context(open(self.__file, 'rb'))
+            pickler = pickle.Pickler(f, protocol=_PROTOCOL)
+            for key, value in self.__data.items():
+                offset = f.tell()
+                source = self.__index.get(key)
+                if source in intact:
+                    if source in copied:
+                        continue
+                    copied.add(source)
+                    keys = intact[source]
+                    old.seek(source)
+                    f.write(old.read(self.__records[source][0]))
+                else:
+                    if source is not None:
+                        if source not in stored:
+                            old.seek(source)
+                            stored[source] = _load_record(old, self.__records[source][0])
+                        value = stored[source][key]
+                    keys = [key]
+                    self._dump({key: value}, f, pickler)
+                records.append((offset, f.tell() - offset, keys))
+            size = f.tell()
+            inode = os.fstat(f.fileno()).st_ino
+        os.replace(self.__tmp, self.__file)
+        self._reset_index()
+        self.__inode = inode
+        for offset, record_size, keys in records:
+            self._register(offset, record_size, keys)
+        self.__size = size
+
+
+def _decode(tag, payload):
+    """Restores a record written behind a tag.
+
+    Args:
+        tag (bytes): The tag of the record.
+        payload (bytes): The data following the tag and its length.
+
+    Returns:
+        dict: Keys and the objects corresponding to them.
+    """
+    if tag == _REMOVAL_TAG:
+        return dict.fromkeys(pickle.loads(payload), _TOMBSTONE)
+    if tag == _ZLIB_TAG:
+        payload = zlib.decompress(payload)
+        if payload[:1] != _MARSHAL_TAG:
+            return pickle.loads(payload)
+        payload = payload[_TAG_SIZE:]
+    return marshal.loads(payload)
+
+
+def _load_record(f, limit):
+    """Reads the record at the current position of the management file.
+
+    Args:
+        f (io.BufferedReader): The management file opened for reading.
+        limit (int): The number of bytes left in the management file from the current position.
+
+    Raises:
+        EOFError: Thrown when the record is cut off.
+
+    Returns:
+        dict: Keys and the objects corresponding to them.
+    """
+    tag = f.peek(1)[:1]
+    if tag != _MARSHAL_TAG and tag != _ZLIB_TAG and tag != _REMOVAL_TAG:
+        return pickle.load(f)
+    length = int.from_bytes(f.read(_TAG_SIZE)[1:], 'little')
+    if _TAG_SIZE + length > limit:
+        raise EOFError("The record is cut off.")
+    return _decode(tag, f.read(length))
+
+
+def _is_cut_off(error):
+    """Returns whether a read failed because the record ends before the management file does.
+
+    Args:
+        error (Exception): The error raised while reading a record.
+
+    Returns:
+        bool: True if the record was only partly written.
+    """
+    if isinstance(error, EOFError):
+        return True
+    return isinstance(error, pickle.UnpicklingError) and str(error) == 'pickle data was truncated'
+
+
+def _is_flat(record):
+    """Returns whether every key and object of the record is a built-in scalar.
+
+    marshal reads such records back exactly, while it turns other objects supporting the buffer protocol into bytes.
+    Only the top level is checked, so that the check stays cheaper than what marshal saves.
+
+    Args:
+        record (dict): Keys and the objects corresponding to them.
+
+    Returns:
+        bool: True if the record can be written with marshal.
+    """
+    for key, value in record.items():
+        if type(key) not in _MARSHAL_TYPES or type(value) not in _MARSHAL_TYPES:
+            return False
+    return True
+
+
+def _write_tagged(f, tag, payload):
+    """Writes data behind a tag and its length.
+
+    Args:
+        f (file): The file to write to.
+        tag (bytes): The tag of the record.
+        payload (bytes): The data to write.
+    """
+    f.write(tag + len(payload).to_bytes(_TAG_SIZE - 1, 'little'))
+    f.write(payload)
 
 
 def get_extension(file):
     """Get the extension from a string or path object.
 
     If the extension cannot be confirmed, None is returned.
+    Dots in directory names are not treated as the extension.
 
     Args:
         file (str or Path): String or path object for the file name.
@@ -355,11 +740,10 @@ def get_extension(file):
     Returns:
         str or None: Extension or None.
     """
-    split_file_name = str(file).split('.')
-    len_ = len(split_file_name)
-    if len_ == 1 or not split_file_name[-1]:
+    _, dot, ext = str(file).rpartition('.')
+    if not dot or not ext or '/' in ext or '\\' in ext:
         return None
-    return split_file_name[-1]
+    return ext
 
 
 def main():
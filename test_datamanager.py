@@ -0,0 +1,209 @@
+from contextlib import redirect_stdout
+from pathlib import Path
+import importlib.util
+import io
+import itertools
+import pickle
+import tempfile
+import unittest
+import zlib
+
+from datamanager import DataManager, get_extension
+import datamanager
+
+OBJECTS = {
+    'number': 1,
+    'text': 'text' * 10,
+    'binary': b'\x00\x01' * 100,
+    'nested': {'list': [1, 2.5, None, (True, b'x')], 'set': {1, 2}},
+    'buffer': bytearray(b'buffer'),
+    'instance': Path('a', 'b'),
+}
+
+
+class Renamed:
+    pass
+
+
+class DataManagerTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = Path(self.directory.name)
+        self.file = self.path / 'test.pkl'
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def open(self, create_newly=False, **kwargs):
+        with redirect_stdout(io.StringIO()):
+            return DataManager('test.pkl', self.directory.name, create_newly=create_newly, **kwargs)
+
+    def test_round_trip(self):
+        for serializer, compress in itertools.product(('pickle', 'marshal'), (False, True)):
+            with self.subTest(serializer=serializer, compress=compress):
+                options = {'serializer': serializer, 'compress': compress}
+                with self.open(True, **options) as dm:
+                    dm.add(**OBJECTS)
+                    dm['number'] = 2
+                    dm.remove('text')
+                dm = self.open(**options)
+                expected = dict(OBJECTS, number=2)
+                del expected['text']
+                self.assertEqual(dict(zip(dm, dm.loads(*dm))), expected)
+                self.assertIs(type(dm['buffer']), bytearray)
+                dm.update()
+                self.assertEqual(dict(zip(dm, dm.loads(*dm))), expected)
+                dm = self.open(serializer='pickle')
+                self.assertEqual(dict(zip(dm, dm.loads(*dm))), expected)
+
+    def test_marshal_flat_records_only(self):
+        dm = self.open(True, serializer='marshal')
+        dm.add(a=1, b='b')
+        self.assertEqual(self.file.read_bytes()[:1], b'M')
+        size = self.file.stat().st_size
+        dm.add(c=[1, 2])
+        self.assertEqual(self.file.read_bytes()[size:size + 2], b'\x80\x04')
+        self.assertEqual(self.open().loads('a', 'b', 'c'), [1, 'b', [1, 2]])
+
+    def test_baseline_format(self):
+        with open(self.file, 'wb') as f:
+            pickle.dump({'a': 1}, f, protocol=3)
+            pickle.dump({'b': [1, 2]}, f, protocol=3)
+        dm = self.open()
+        self.assertEqual(dm.loads('a', 'b'), [1, [1, 2]])
+        dm['a'] = 3
+        self.assertEqual(self.open().loads('a', 'b'), [3, [1, 2]])
+
+    def test_shared_references(self):
+        x, y = [1], [2]
+        with open(self.file, 'wb') as f:
+            pickle.dump({'a': [x, x]}, f, protocol=4)
+            pickle.dump({'b': [y, y]}, f, protocol=4)
+        dm = self.open()
+        self.assertEqual(dm.loads('a', 'b'), [[[1], [1]], [[2], [2]]])
+        self.assertIs(dm['b'][0], dm['b'][1])
+        dm.remove('a')
+        dm.update()
+        self.assertEqual(self.open()['b'], [[2], [2]])
+
+    def test_torn_tail(self):
+        dm = self.open(True)
+        dm.add(a=1, b=[1, 2])
+        size = self.file.stat().st_size
+        for tail in (b'garbage', pickle.dumps({'c': 'c' * 100})[:-10], b'\x80', b'M\xff', b'Z\xff' * 8):
+            with self.subTest(tail=tail):
+                with open(self.file, 'ab') as f:
+                    f.write(tail)
+                dm = self.open()
+                self.assertEqual(dm.loads('a', 'b'), [1, [1, 2]])
+                self.assertEqual(self.file.stat().st_size, size)
+
+    def test_unreadable_record(self):
+        lost_class = pickle.dumps({'x': Renamed()}, protocol=4).replace(b'Renamed', b'Mislaid')
+        corrupt = b'Z' + (4).to_bytes(8, 'little') + b'\x00' * 4
+        for record, error in ((lost_class, AttributeError), (corrupt, zlib.error)):
+            with self.subTest(error=error):
+                with open(self.file, 'wb') as f:
+                    pickle.dump({'a': 1}, f, protocol=4)
+                    f.write(record)
+                    pickle.dump({'b': 2, 'c': 3}, f, protocol=4)
+                content = self.file.read_bytes()
+                with self.assertRaises(error):
+                    self.open()
+                self.assertEqual(self.file.read_bytes(), content)
+
+    def test_unreadable_file(self):
+        for content in (b'\x80', b'garbage'):
+            with self.subTest(content=content):
+                self.file.write_bytes(content)
+                with self.assertRaises(Exception):
+                    self.open()
+                self.assertEqual(self.file.read_bytes(), content)
+
+    def test_empty_file(self):
+        self.file.write_bytes(b'')
+        dm = self.open()
+        self.assertEqual(len(dm), 0)
+        dm.add(a=1)
+        self.assertEqual(self.open()['a'], 1)
+
+    def test_compaction_after_removals(self):
+        dm = self.open(True)
+        dm.add(**{f'key{i}': i for i in range(100)})
+        for i in range(0, 100, 2):
+            dm.remove(f'key{i}')
+        size = self.file.stat().st_size
+        dm.update()
+        self.assertLess(self.file.stat().st_size, size)
+        dm = self.open()
+        self.assertEqual(list(dm), [f'key{i}' for i in range(1, 100, 2)])
+        self.assertEqual(dm.loads(*dm), list(range(1, 100, 2)))
+
+    def test_removals_are_compacted(self):
+        dm = self.open(True)
+        for i in range(1000):
+            dm.add(**{f'key{i}': i})
+        size = self.file.stat().st_size
+        for i in range(1000):
+            dm.remove(f'key{i}')
+        self.assertEqual(len(dm), 0)
+        self.assertLess(self.file.stat().st_size, size)
+        dm = self.open()
+        self.assertEqual(len(dm), 0)
+        self.assertLess(self.file.stat().st_size, size)
+
+    def test_removals_do_not_depend_on_import_name(self):
+        spec = importlib.util.spec_from_file_location('package.datamanager', datamanager.__file__)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        with redirect_stdout(io.StringIO()):
+            dm = module.DataManager('test.pkl', self.directory.name)
+        dm.add(a=1, z=2)
+        dm.add(b=3, c=4)
+        dm.remove('a')
+        self.assertEqual(list(self.open()), ['z', 'b', 'c'])
+
+    def test_partly_superseded_records_are_compacted(self):
+        for remove in (False, True):
+            with self.subTest(remove=remove):
+                with self.open(True) as dm:
+                    dm.add(big=b'x' * 1000000, small=1)
+                    if remove:
+                        dm.remove('big')
+                    else:
+                        dm['big'] = b'y'
+                self.assertLess(self.file.stat().st_size, 1000)
+                dm = self.open()
+                self.assertEqual(dict(zip(dm, dm.loads(*dm))), {'small': 1} if remove else {'big': b'y', 'small': 1})
+
+    def test_in_place_changes_are_not_saved(self):
+        for remove in (False, True):
+            with self.subTest(remove=remove):
+                dm = self.open(True)
+                dm.add(a=[1], b=[2])
+                dm['a'].append(9)
+                if remove:
+                    dm.remove('b')
+                dm.update()
+                self.assertEqual(self.open()['a'], [1])
+                dm['a'] = dm['a']
+                self.assertEqual(self.open()['a'], [1, 9])
+
+    def test_rewrite_unserializable(self):
+        dm = self.open(True)
+        dm['a'] = 1
+        with self.assertRaises(Exception):
+            dm['a'] = lambda: None
+        self.assertEqual(dm['a'], 1)
+        self.assertEqual(self.open()['a'], 1)
+
+    def test_get_extension(self):
+        self.assertEqual(get_extension('a.pkl'), 'pkl')
+        self.assertEqual(get_extension(Path('a', 'b.dat')), 'dat')
+        self.assertIsNone(get_extension('a'))
+        self.assertIsNone(get_extension('a.'))
+        self.assertIsNone(get_extension('dir.v1/file'))
+
+
+if __name__ == '__main__':
+    unittest.main()